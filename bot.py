@@ -2,11 +2,14 @@
 # ✅ JP+EN UI（locale_str）/ ギルド即時同期（copy→sync）/ 再登録クリアオプション
 # ✅ 掲示板は固定チャンネルにのみ出力（個別の公開メッセージなし）
 # ✅ サービスチケットの管理用コマンド（ユーザー・サービス名・減らす枚数）追加
+# ✅ 追記専用の取引台帳 + 定期残高スナップショット / 取引履歴（キーセットページング）
+# ✅ サービス名のオートコンプリート（ギルド別メモリ内ソート索引・前方一致）
 
 import os
 import asyncio
 import logging
 import re
+from bisect import bisect_left, insort
 from datetime import datetime, timedelta, timezone
 from typing import Optional, Dict, Tuple, List, Callable, Awaitable
 
@@ -41,6 +44,13 @@ RESULT_BOARD_CHANNEL_ID = int(os.getenv("RESULT_BOARD_CHANNEL_ID", "0") or 0)
 # DB パス
 DB_PATH = os.getenv("DB_PATH", "data.sqlite3")
 
+# 台帳スナップショット間隔（ユーザーごとの台帳行数）
+LEDGER_SNAPSHOT_INTERVAL = max(1, int(os.getenv("LEDGER_SNAPSHOT_INTERVAL", "50") or 50))
+
+# /history の1ページ件数 / 一言の表示上限
+HISTORY_PAGE_SIZE = 10
+HISTORY_NOTE_MAX = 100
+
 # =============================
 # 🧱 DB 初期化
 # =============================
@@ -79,6 +89,30 @@ CREATE TABLE IF NOT EXISTS contracts (
   created_at  TEXT NOT NULL,
   accepted_at TEXT
 );
+
+-- 追記専用の取引台帳（UPDATE/DELETE しない）
+CREATE TABLE IF NOT EXISTS ledger (
+  id         INTEGER PRIMARY KEY AUTOINCREMENT,
+  guild_id   INTEGER NOT NULL,
+  user_id    INTEGER NOT NULL,
+  delta      INTEGER NOT NULL,
+  balance    INTEGER NOT NULL, -- 変動後の残高
+  kind       TEXT NOT NULL,    -- 'send'|'receive'|'adjust'|'purchase'
+  ref        TEXT,             -- 'to:<user_id>'|'from:<user_id>'|'by:<user_id>'|サービス名
+  note       TEXT,             -- 送金時の一言など（任意）
+  created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ledger_user ON ledger (guild_id, user_id, id);
+
+-- 残高スナップショット（ledger_id 時点の残高。0 は台帳導入前の期首残高）
+CREATE TABLE IF NOT EXISTS balance_snapshots (
+  guild_id   INTEGER NOT NULL,
+  user_id    INTEGER NOT NULL,
+  ledger_id  INTEGER NOT NULL,
+  balance    INTEGER NOT NULL,
+  created_at TEXT NOT NULL,
+  PRIMARY KEY (guild_id, user_id, ledger_id)
+);
 """
 
 # =============================
@@ -99,13 +133,67 @@ async def get_balance(db: aiosqlite.Connection, guild_id: int, user_id: int) ->
     row = await cur.fetchone()
     return int(row[0]) if row else 0
 
-async def add_balance(db: aiosqlite.Connection, guild_id: int, user_id: int, delta: int) -> int:
+# 残高変更（UPDATE + 台帳 INSERT）〜 commit/ROLLBACK までを1単位にするためのロック
+# 共有接続上で他のハンドラの commit/ROLLBACK が途中に割り込まないようにする
+balance_lock = asyncio.Lock()
+
+async def add_balance(
+    db: aiosqlite.Connection, guild_id: int, user_id: int, delta: int, kind: str,
+    ref: Optional[str] = None, note: Optional[str] = None
+) -> int:
+    """残高を増減し、同じトランザクション内で台帳に1行追記する。
+    呼び出し側は balance_lock を保持したまま commit まで行うこと"""
     await ensure_balance(db, guild_id, user_id)
     await db.execute("UPDATE balances SET balance = balance + ? WHERE guild_id=? AND user_id=?", (delta, guild_id, user_id))
     cur = await db.execute("SELECT balance FROM balances WHERE guild_id=? AND user_id=?", (guild_id, user_id))
     row = await cur.fetchone()
-    return int(row[0]) if row else 0
+    new_bal = int(row[0]) if row else 0
+    await append_ledger(db, guild_id, user_id, delta, new_bal, kind, ref, note)
+    return new_bal
 
+# =============================
+# 🏷️ サービスラベル索引（オートコンプリート用・メモリ内）
+# =============================
+class TicketLabelIndex:
+    """ギルドごとのソート済みラベル一覧。前方一致を二分探索で返す（SQLite には触れない）"""
+
+    def __init__(self):
+        self._by_guild: Dict[int, List[Tuple[str, str]]] = {}  # guild_id -> [(casefold, label)]
+
+    async def load(self, db: aiosqlite.Connection) -> None:
+        by_guild: Dict[int, List[Tuple[str, str]]] = {}
+        cur = await db.execute("SELECT DISTINCT guild_id, label FROM tickets")
+        async for guild_id, label in cur:
+            by_guild.setdefault(int(guild_id), []).append((label.casefold(), label))
+        for entries in by_guild.values():
+            entries.sort()
+        self._by_guild = by_guild
+
+    def add(self, guild_id: int, label: str) -> None:
+        if (guild_id, label) not in self:
+            insort(self._by_guild.setdefault(guild_id, []), (label.casefold(), label))
+
+    def __contains__(self, item: Tuple[int, str]) -> bool:
+        guild_id, label = item
+        entries = self._by_guild.get(guild_id, [])
+        key = (label.casefold(), label)
+        i = bisect_left(entries, key)
+        return i < len(entries) and entries[i] == key
+
+    def search(self, guild_id: int, prefix: str, limit: int = 25) -> List[str]:
+        entries = self._by_guild.get(guild_id, [])
+        folded = prefix.casefold()
+        out: List[str] = []
+        for i in range(bisect_left(entries, (folded,)), len(entries)):
+            key, label = entries[i]
+            if not key.startswith(folded) or len(out) >= limit:
+                break
+            out.append(label)
+        return out
+
+ticket_labels = TicketLabelIndex()
+
+# add_ticket / set_ticket は索引を更新しない。呼び出し側が commit 成功後に ticket_labels.add する
 async def add_ticket(db: aiosqlite.Connection, guild_id: int, user_id: int, label: str, n: int = 1) -> int:
     await db.execute(
         "INSERT OR IGNORE INTO tickets (guild_id, user_id, label, count) VALUES (?, ?, ?, 0)",
@@ -153,6 +241,103 @@ async def get_board_message_id(db: aiosqlite.Connection, guild_id: int, channel_
     row = await cur.fetchone()
     return int(row[0]) if row else None
 
+# =============================
+# 📒 取引台帳 / スナップショット
+# =============================
+async def append_ledger(
+    db: aiosqlite.Connection, guild_id: int, user_id: int, delta: int, balance: int,
+    kind: str, ref: Optional[str], note: Optional[str] = None
+) -> int:
+    cur = await db.execute(
+        "INSERT INTO ledger (guild_id, user_id, delta, balance, kind, ref, note, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        (guild_id, user_id, delta, balance, kind, ref, note, jst_now_str())
+    )
+    ledger_id = int(cur.lastrowid)
+    await maybe_snapshot(db, guild_id, user_id, ledger_id, balance)
+    return ledger_id
+
+async def latest_snapshot(db: aiosqlite.Connection, guild_id: int, user_id: int) -> Tuple[int, int]:
+    """最新スナップショットの (ledger_id, balance)。無ければ (0, 0)"""
+    cur = await db.execute(
+        "SELECT ledger_id, balance FROM balance_snapshots WHERE guild_id=? AND user_id=? ORDER BY ledger_id DESC LIMIT 1",
+        (guild_id, user_id)
+    )
+    row = await cur.fetchone()
+    return (int(row[0]), int(row[1])) if row else (0, 0)
+
+async def maybe_snapshot(db: aiosqlite.Connection, guild_id: int, user_id: int, ledger_id: int, balance: int) -> None:
+    """前回スナップショット以降の台帳行が間隔に達したらチェックポイントを残す。
+    値は balances ではなく「前回スナップショット + 台帳差分」から求め、balances と食い違えば記録しない"""
+    snap_id, snap_bal = await latest_snapshot(db, guild_id, user_id)
+    cur = await db.execute(
+        "SELECT COUNT(*), COALESCE(SUM(delta), 0) FROM ledger WHERE guild_id=? AND user_id=? AND id > ? AND id <= ?",
+        (guild_id, user_id, snap_id, ledger_id)
+    )
+    row = await cur.fetchone()
+    if not row or int(row[0]) < LEDGER_SNAPSHOT_INTERVAL:
+        return
+    derived = snap_bal + int(row[1])
+    if derived != balance:
+        logger.warning(
+            f"Ledger mismatch guild={guild_id} user={user_id} ledger_id={ledger_id}: "
+            f"ledger={derived} balances={balance}; snapshot skipped"
+        )
+        return
+    await db.execute(
+        "INSERT OR IGNORE INTO balance_snapshots (guild_id, user_id, ledger_id, balance, created_at) VALUES (?, ?, ?, ?, ?)",
+        (guild_id, user_id, ledger_id, derived, jst_now_str())
+    )
+
+async def seed_opening_snapshots(db: aiosqlite.Connection) -> None:
+    """台帳導入前からある残高を期首スナップショット（ledger_id=0）として記録"""
+    await db.execute(
+        "INSERT OR IGNORE INTO balance_snapshots (guild_id, user_id, ledger_id, balance, created_at) "
+        "SELECT b.guild_id, b.user_id, 0, b.balance, ? FROM balances b "
+        "WHERE b.balance != 0 "
+        "AND NOT EXISTS (SELECT 1 FROM balance_snapshots s WHERE s.guild_id=b.guild_id AND s.user_id=b.user_id) "
+        "AND NOT EXISTS (SELECT 1 FROM ledger l WHERE l.guild_id=b.guild_id AND l.user_id=b.user_id)",
+        (jst_now_str(),)
+    )
+
+async def rebuild_balance(db: aiosqlite.Connection, guild_id: int, user_id: int) -> int:
+    """最新スナップショット + それ以降の台帳差分から残高を再計算"""
+    snap_id, snap_bal = await latest_snapshot(db, guild_id, user_id)
+    cur = await db.execute(
+        "SELECT COALESCE(SUM(delta), 0) FROM ledger WHERE guild_id=? AND user_id=? AND id > ?",
+        (guild_id, user_id, snap_id)
+    )
+    row = await cur.fetchone()
+    return snap_bal + (int(row[0]) if row else 0)
+
+async def fetch_ledger_page(
+    db: aiosqlite.Connection, guild_id: int, user_id: int,
+    before_id: Optional[int] = None, after_id: Optional[int] = None, limit: int = HISTORY_PAGE_SIZE
+) -> List[Tuple[int, int, int, str, Optional[str], Optional[str], str]]:
+    """(guild_id, user_id, id) のキーセットで新しい順に1ページ取得（OFFSET は使わない）"""
+    if after_id is not None:
+        cur = await db.execute(
+            "SELECT id, delta, balance, kind, ref, note, created_at FROM ledger "
+            "WHERE guild_id=? AND user_id=? AND id > ? ORDER BY id ASC LIMIT ?",
+            (guild_id, user_id, after_id, limit)
+        )
+        rows = list(reversed(await cur.fetchall()))
+    else:
+        cur = await db.execute(
+            "SELECT id, delta, balance, kind, ref, note, created_at FROM ledger "
+            "WHERE guild_id=? AND user_id=? AND id < ? ORDER BY id DESC LIMIT ?",
+            (guild_id, user_id, before_id if before_id is not None else 2**63 - 1, limit)
+        )
+        rows = list(await cur.fetchall())
+    return [(int(i), int(d), int(b), str(k), r, n, str(t)) for i, d, b, k, r, n, t in rows]
+
+async def ledger_neighbors(db: aiosqlite.Connection, guild_id: int, user_id: int, first_id: int, last_id: int) -> Tuple[bool, bool]:
+    """ページ前後に (より新しい行, より古い行) があるか"""
+    cur = await db.execute("SELECT 1 FROM ledger WHERE guild_id=? AND user_id=? AND id > ? LIMIT 1", (guild_id, user_id, first_id))
+    has_newer = await cur.fetchone() is not None
+    cur = await db.execute("SELECT 1 FROM ledger WHERE guild_id=? AND user_id=? AND id < ? LIMIT 1", (guild_id, user_id, last_id))
+    has_older = await cur.fetchone() is not None
+    return has_newer, has_older
+
 # =============================
 # 🤖 Bot セットアップ
 # =============================
@@ -171,7 +356,9 @@ class YenBot(commands.Bot):
     async def setup_hook(self) -> None:
         self.db = await aiosqlite.connect(DB_PATH)
         await self.db.executescript(INIT_SQL)
+        await seed_opening_snapshots(self.db)
         await self.db.commit()
+        await ticket_labels.load(self.db)
 
         # --- スラッシュ即時反映: グローバル→ギルドコピー + ギルド同期 ---
         if GUILD_IDS:
@@ -255,14 +442,14 @@ async def send(inter: discord.Interaction, user: discord.Member, amount: app_com
         await inter.response.send_message("Bot へは送金できません / Cannot send to bots.", ephemeral=True)
         return
 
-    async with bot.db.execute("BEGIN"):
+    async with balance_lock, bot.db.execute("BEGIN"):
         sender_bal = await get_balance(bot.db, guild.id, inter.user.id)
         if sender_bal < amount:
-            await inter.response.send_message(f"残高不足 / Insufficient balance: {sender_bal}{CURRENCY_NAME}", ephemeral=True)
             await bot.db.execute("ROLLBACK")
+            await inter.response.send_message(f"残高不足 / Insufficient balance: {sender_bal}{CURRENCY_NAME}", ephemeral=True)
             return
-        await add_balance(bot.db, guild.id, inter.user.id, -amount)
-        await add_balance(bot.db, guild.id, user.id, amount)
+        await add_balance(bot.db, guild.id, inter.user.id, -amount, "send", f"to:{user.id}", note)
+        await add_balance(bot.db, guild.id, user.id, amount, "receive", f"from:{inter.user.id}", note)
         await bot.db.commit()
 
     # 公開メッセージは出さない → 最小限のエフェメラルのみ
@@ -297,6 +484,108 @@ async def balance(inter: discord.Interaction, user: Optional[discord.Member] = N
     e.add_field(name="残高 / Amount", value=f"{bal}{CURRENCY_NAME}", inline=True)
     await inter.response.send_message(embed=e, ephemeral=True)
 
+# =============================
+# 📜 取引履歴（/history → 取引履歴 / History）
+# =============================
+LEDGER_KIND_LABELS = {
+    "send": "送金 / Send",
+    "receive": "受取 / Receive",
+    "adjust": "調整 / Adjust",
+    "purchase": "購入 / Purchase",
+}
+
+def format_ledger_ref(ref: str) -> str:
+    """'to:<id>' などのユーザー参照はメンション表示、それ以外（サービス名）はそのまま"""
+    m = re.fullmatch(r"(to|from|by):(\d+)", ref)
+    return f"{m.group(1)} <@{m.group(2)}>" if m else ref
+
+class HistoryView(discord.ui.View):
+    def __init__(self, viewer_id: int, guild_id: int, target: discord.abc.User):
+        super().__init__(timeout=300)
+        self.viewer_id = viewer_id
+        self.guild_id = guild_id
+        self.target = target
+        self.first_id: Optional[int] = None
+        self.last_id: Optional[int] = None
+
+    async def interaction_check(self, inter: discord.Interaction) -> bool:
+        return inter.user.id == self.viewer_id
+
+    async def render(self, before_id: Optional[int] = None, after_id: Optional[int] = None) -> discord.Embed:
+        assert bot.db is not None
+        rows = await fetch_ledger_page(bot.db, self.guild_id, self.target.id, before_id=before_id, after_id=after_id)
+        e = em_title("取引履歴 / History")
+        e.add_field(name="ユーザー / User", value=self.target.mention, inline=True)
+        # スナップショット + 差分で再計算した残高と現在残高を照合（全ページ共通）
+        async with balance_lock:
+            bal = await get_balance(bot.db, self.guild_id, self.target.id)
+            rebuilt = await rebuild_balance(bot.db, self.guild_id, self.target.id)
+        status = "OK" if bal == rebuilt else f"不一致 / Mismatch ({rebuilt}{CURRENCY_NAME})"
+        e.add_field(name="残高 / Balance", value=f"{bal}{CURRENCY_NAME}", inline=True)
+        e.add_field(name="検証 / Verify", value=status, inline=True)
+        if not rows:
+            e.description = "履歴はありません。\nNo history."
+            self.newer.disabled = True
+            self.older.disabled = True
+            return e
+
+        # 説明欄に収まる行だけ表示し、last_id は実際に表示した最後の行に合わせる
+        self.first_id = rows[0][0]
+        lines: List[str] = []
+        size = 0
+        for lid, delta, after, kind, ref, note, created_at in rows:
+            line = f"`#{lid}` {created_at} | {LEDGER_KIND_LABELS.get(kind, kind)} | {delta:+d}{CURRENCY_NAME} → {after}{CURRENCY_NAME}"
+            if ref:
+                line += f" | {format_ledger_ref(ref)}"
+            if note:
+                if len(note) > HISTORY_NOTE_MAX:
+                    note = note[:HISTORY_NOTE_MAX - 1] + "…"
+                line += f" | 「{note}」"
+            size += len(line) + 1
+            if lines and size > 4000:
+                break
+            lines.append(line)
+            self.last_id = lid
+        e.description = "\n".join(lines)
+        has_newer, has_older = await ledger_neighbors(bot.db, self.guild_id, self.target.id, self.first_id, self.last_id)
+        self.newer.disabled = not has_newer
+        self.older.disabled = not has_older
+        return e
+
+    @discord.ui.button(label="◀ 新しい / Newer", style=discord.ButtonStyle.secondary)
+    async def newer(self, inter: discord.Interaction, btn: discord.ui.Button):
+        e = await self.render(after_id=self.first_id)
+        await inter.response.edit_message(embed=e, view=self)
+
+    @discord.ui.button(label="古い ▶ / Older", style=discord.ButtonStyle.secondary)
+    async def older(self, inter: discord.Interaction, btn: discord.ui.Button):
+        e = await self.render(before_id=self.last_id)
+        await inter.response.edit_message(embed=e, view=self)
+
+@bot.tree.command(
+    name=ls("history", ja="取引履歴"),
+    description=ls("Show transaction history", ja="自分または特定ユーザーの取引履歴を表示します")
+)
+@app_commands.describe(user="対象（未指定なら自分）/ Target (self if omitted)")
+async def history(inter: discord.Interaction, user: Optional[discord.Member] = None):
+    assert bot.db is not None
+    guild = inter.guild
+    assert guild is not None
+
+    target = user or inter.user
+    if target.id != inter.user.id:
+        if BALANCE_AUDIT_ROLE_ID and isinstance(inter.user, discord.Member):
+            if discord.utils.get(inter.user.roles, id=BALANCE_AUDIT_ROLE_ID) is None:
+                await inter.response.send_message("権限がありません / No permission.", ephemeral=True)
+                return
+        else:
+            await inter.response.send_message("権限がありません / No permission.", ephemeral=True)
+            return
+
+    view = HistoryView(inter.user.id, guild.id, target)
+    e = await view.render()
+    await inter.response.send_message(embed=e, view=view, ephemeral=True)
+
 # =============================
 # 🧮 金額調整（/adjust → 金額調整 / Adjust）
 # =============================
@@ -325,8 +614,9 @@ async def adjust(inter: discord.Interaction, user: discord.Member, delta: str):
     sign, num = m.group(1), int(m.group(2))
     amount = num if sign == "+" else -num
 
-    new_bal = await add_balance(bot.db, guild.id, user.id, amount)
-    await bot.db.commit()
+    async with balance_lock:
+        new_bal = await add_balance(bot.db, guild.id, user.id, amount, "adjust", f"by:{inter.user.id}")
+        await bot.db.commit()
 
     e = em_title("残高調整 / Adjust")
     e.add_field(name="対象 / User", value=user.mention, inline=True)
@@ -349,14 +639,16 @@ class ServiceButton(discord.ui.Button):
         guild = inter.guild
         assert guild is not None
 
-        bal = await get_balance(bot.db, guild.id, inter.user.id)
-        if bal < self.price:
-            await inter.response.send_message(f"残高不足 / Insufficient: {bal}{CURRENCY_NAME}", ephemeral=True)
-            return
+        async with balance_lock:
+            bal = await get_balance(bot.db, guild.id, inter.user.id)
+            if bal < self.price:
+                await inter.response.send_message(f"残高不足 / Insufficient: {bal}{CURRENCY_NAME}", ephemeral=True)
+                return
 
-        await add_balance(bot.db, guild.id, inter.user.id, -self.price)
-        await add_ticket(bot.db, guild.id, inter.user.id, self.raw_label, 1)
-        await bot.db.commit()
+            await add_balance(bot.db, guild.id, inter.user.id, -self.price, "purchase", self.raw_label)
+            await add_ticket(bot.db, guild.id, inter.user.id, self.raw_label, 1)
+            await bot.db.commit()
+        ticket_labels.add(guild.id, self.raw_label)
 
         await inter.response.send_message("購入完了 / Purchased.", ephemeral=True)
         await update_ticket_board()  # 固定チャンネルの掲示板を更新
@@ -447,6 +739,12 @@ async def setup_ticket_board(inter: discord.Interaction):
 # =============================
 # 🛠 管理: サービスチケット調整（減らす枚数）
 # =============================
+async def service_label_autocomplete(inter: discord.Interaction, current: str) -> List[app_commands.Choice[str]]:
+    """チケット系コマンドの service 引数用（メモリ内索引から前方一致）"""
+    if inter.guild is None:
+        return []
+    return [app_commands.Choice(name=label[:100], value=label) for label in ticket_labels.search(inter.guild.id, current)]
+
 @bot.tree.command(
     name=ls("service_ticket_adjust", ja="サービスチケット調整"),
     description=ls("Adjust service tickets for a user", ja="ユーザーのサービスチケット枚数を調整します")
@@ -456,6 +754,7 @@ async def setup_ticket_board(inter: discord.Interaction):
     service="サービス名（ラベル）/ Service label",
     dec="減らす枚数（正数）/ Decrease count (positive)"
 )
+@app_commands.autocomplete(service=service_label_autocomplete)
 async def service_ticket_adjust(inter: discord.Interaction, user: discord.Member, service: str, dec: app_commands.Range[int, 1, 10_000]):
     assert bot.db is not None
     guild = inter.guild
@@ -469,16 +768,28 @@ async def service_ticket_adjust(inter: discord.Interaction, user: discord.Member
         await inter.response.send_message("権限がありません / No permission.", ephemeral=True)
         return
 
+    # 未登録のラベルで 0 枚の行を作らない
+    if (guild.id, service) not in ticket_labels:
+        await inter.response.send_message(f"不明なサービス名 / Unknown service: {service}", ephemeral=True)
+        return
+
     # 現在値を取得 → 減算（マイナスは0で止める）
     cur = await bot.db.execute(
         "SELECT count FROM tickets WHERE guild_id=? AND user_id=? AND label=?",
         (guild.id, user.id, service)
     )
     row = await cur.fetchone()
-    current = int(row[0]) if row else 0
+    if row is None:
+        await inter.response.send_message(f"{user.mention} は {service} のチケットを持っていません / User has no {service} tickets.", ephemeral=True)
+        return
+    current = int(row[0])
+    if current == 0:
+        await inter.response.send_message(f"{user.mention} の {service} は既に0枚です / Already 0 {service} tickets.", ephemeral=True)
+        return
     new_count = max(0, current - int(dec))
     await set_ticket(bot.db, guild.id, user.id, service, new_count)
     await bot.db.commit()
+    ticket_labels.add(guild.id, service)
 
     await inter.response.send_message(f"調整完了: {user.mention} / {service} / {current} → {new_count}", ephemeral=True)
     await update_ticket_board()